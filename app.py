@@ -1,123 +1,777 @@
-from flask import Flask, request, jsonify, send_file, abort
+# Parchear la librería estándar antes de cualquier otro import para que las
+# operaciones de red bloqueantes cedan el control entre greenlets
+from gevent import monkey
+monkey.patch_all()
+
+from flask import Flask, request, jsonify, send_file, abort, Response, stream_with_context
+from gevent.pywsgi import WSGIServer
+from gevent.threadpool import ThreadPoolExecutor as NativeThreadPoolExecutor
+from werkzeug.exceptions import HTTPException, RequestedRangeNotSatisfiable
 import os
 import tempfile
 import shutil
+import zipfile
+import hashlib
+import stat
+import threading
+import time
+import uuid
+import json
+import socket
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
 from urllib.parse import urlparse
 import re
+import subprocess
 from deezspot.deezloader import DeeLogin
 import logging
+import logging.handlers
+import atexit
+
+# zlib-ng (opcional) calcula el CRC32 con instrucciones específicas de la CPU.
+# Con ZIP_STORED el CRC de cada miembro es el único trabajo de CPU al generar
+# el ZIP, así que zipfile usa esta implementación si está instalada
+try:
+    from zlib_ng import zlib_ng
+    zipfile.crc32 = zlib_ng.crc32
+except ImportError:
+    pass
 
 app = Flask(__name__)
 
-# Configurar logging
-logging.basicConfig(level=logging.INFO)
+class NativeQueueListener(logging.handlers.QueueListener):
+    """
+    QueueListener que vacía la cola en un hilo real del sistema. Con
+    monkey.patch_all() el hilo de QueueListener sería un greenlet del mismo
+    hilo que atiende las peticiones y escribiría en stderr desde el hub
+    """
+    def start(self):
+        self._executor = NativeThreadPoolExecutor(max_workers=1)
+        self._monitor_future = self._executor.submit(self._monitor)
+
+    def stop(self):
+        self.enqueue_sentinel()
+        self._monitor_future.result()
+        self._executor.shutdown()
+
+# Configurar logging: los workers solo encolan los registros y un hilo aparte
+# los escribe, para no bloquear las peticiones en el lock de stderr. La cola es
+# la SimpleQueue original (no la de gevent) porque se lee desde otro hilo
+log_queue = monkey.get_original('queue', 'SimpleQueue')()
+log_stream_handler = logging.StreamHandler()
+log_stream_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+root_logger = logging.getLogger()
+root_logger.setLevel(logging.INFO)
+root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+log_listener = NativeQueueListener(log_queue, log_stream_handler, respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)
 logger = logging.getLogger(__name__)
 
+# Calidades de audio aceptadas por el parámetro quality: la tupla conserva el
+# orden para los mensajes de error y el frozenset se usa para comprobarlas
+QUALITY_OPTIONS = ('MP3_128', 'MP3_320', 'FLAC')
+ALLOWED_QUALITIES = frozenset(QUALITY_OPTIONS)
+
+# IDs de Deezer válidos: solo dígitos ASCII (str.isdigit acepta otros dígitos Unicode)
+ID_RE = re.compile(r'[0-9]{1,12}')
+
+# Caracteres no permitidos en nombres de archivo
+FILENAME_SANITIZE_RE = re.compile(r'[<>:"/\\|?*]')
+
 # Obtener ARL token desde variables de entorno
 ARL_TOKEN = os.getenv('DEEZER_ARL_TOKEN')
 if not ARL_TOKEN:
     raise ValueError("La variable de entorno DEEZER_ARL_TOKEN no está definida")
 
-# Inicializar cliente de Deezer
-deezer = DeeLogin(arl=ARL_TOKEN, email='', password='', tags_separator=" / ")
+# Validar el ARL al arrancar, para que el servidor no se inicie con un token
+# inválido y falle después en cada descarga
+DeeLogin(arl=ARL_TOKEN, email='', password='', tags_separator=" / ")
+
+# Cliente de Deezer. Las descargas (red y descifrado, con el GIL tomado) se
+# ejecutan en procesos aparte; cada proceso crea su propio cliente al arrancar
+# porque la sesión no se puede compartir ni serializar entre procesos
+deezer = None
+
+def release_inherited_sockets():
+    """
+    Suelta los sockets heredados del worker web al hacer fork (el de escucha y
+    las conexiones de clientes). Si el proceso de descarga los mantuviera
+    abiertos, al cerrarlos el worker no se enviaría el FIN y los clientes de
+    respuestas sin Content-Length o con keep-alive se quedarían esperando.
+    Cada descriptor se apunta a /dev/null en lugar de cerrarlo, para que los
+    objetos socket copiados en este proceso no cierren después otro archivo.
+    """
+    try:
+        fds = [int(fd) for fd in os.listdir('/proc/self/fd')]
+    except OSError:
+        return
+    devnull = os.open(os.devnull, os.O_RDWR)
+    try:
+        for fd in fds:
+            # stdin, stdout y stderr pueden ser sockets (p. ej. con systemd)
+            if fd <= 2 or fd == devnull:
+                continue
+            try:
+                if stat.S_ISSOCK(os.fstat(fd).st_mode):
+                    os.dup2(devnull, fd)
+            except OSError:
+                pass
+    finally:
+        os.close(devnull)
+
+def init_download_worker(arl):
+    """Inicializa el cliente de Deezer en un proceso de descarga"""
+    global deezer
+    release_inherited_sockets()
+    # El hilo que vacía log_queue no existe en este proceso: escribir directamente
+    logging.getLogger().handlers = [log_stream_handler]
+    deezer = DeeLogin(arl=arl, email='', password='', tags_separator=" / ")
+
+# Cada worker de gunicorn tiene su propio pool de descargas, así que los núcleos
+# se reparten entre WEB_CONCURRENCY workers (gunicorn también usa esta variable
+# como número de workers por defecto)
+WEB_WORKERS = int(os.getenv('WEB_CONCURRENCY', 1))
+DOWNLOAD_PROCESSES = int(os.getenv(
+    'MUSIFYX_DOWNLOAD_PROCESSES',
+    max(1, (os.cpu_count() or 1) // WEB_WORKERS)
+))
+download_pool = None
+download_pool_lock = threading.Lock()
+
+def get_download_pool():
+    """Devuelve el pool de procesos de descarga, creándolo si aún no existe"""
+    global download_pool
+    with download_pool_lock:
+        if download_pool is None:
+            # Los procesos se crean con fork: heredan la configuración del módulo
+            # sin volver a importarlo. Con fork el pool lanza todos sus procesos
+            # en el primer submit, así que se lanzan ya y no dentro de una petición
+            download_pool = ProcessPoolExecutor(
+                max_workers=DOWNLOAD_PROCESSES,
+                mp_context=multiprocessing.get_context('fork'),
+                initializer=init_download_worker,
+                initargs=(ARL_TOKEN,)
+            )
+            download_pool.submit(os.getpid)
+        return download_pool
+
+def discard_download_pool(pool):
+    """
+    Descarta un pool roto para que la siguiente descarga cree uno nuevo.
+    El pool roto ya termina sus procesos por sí mismo al detectar el fallo.
+    """
+    global download_pool
+    with download_pool_lock:
+        if download_pool is pool:
+            download_pool = None
+
+# Límite de descargas simultáneas contra Deezer, para no provocar errores 429
+# ni llenar el disco. Con gevent, threading está parcheado y las peticiones que
+# esperan el semáforo ceden el control en lugar de bloquear un hilo
+MAX_PARALLEL_DOWNLOADS = int(os.getenv('MUSIFYX_MAX_PARALLEL', 4))
+download_semaphore = threading.BoundedSemaphore(MAX_PARALLEL_DOWNLOADS)
+download_stats = {'active': 0, 'waiting': 0}
+download_stats_lock = threading.Lock()
+
+# Directorio para las descargas temporales. Se recomienda un tmpfs (p. ej.
+# /dev/shm/musifyx): cada pista se escribe y se borra en segundos, así que en
+# memoria se evitan las escrituras a disco. Si no se define se usa el de tempfile
+TEMP_ROOT = os.getenv('MUSIFYX_TMP')
+TEMP_ROOT_MIN_BYTES = int(os.getenv('MUSIFYX_TMP_MIN_BYTES', 2 * 1024 ** 3))
+
+def mount_fstype(path):
+    """Devuelve el tipo de sistema de archivos montado en path según /proc/mounts"""
+    path = os.path.realpath(path)
+    best_mount, best_type = '', None
+    try:
+        with open('/proc/mounts') as mounts:
+            for line in mounts:
+                fields = line.split()
+                mount_point = fields[1].replace('\\040', ' ')
+                if (path == mount_point or path.startswith(mount_point.rstrip('/') + '/')) \
+                        and len(mount_point) >= len(best_mount):
+                    best_mount, best_type = mount_point, fields[2]
+    except OSError:
+        return None
+    return best_type
+
+if TEMP_ROOT:
+    os.makedirs(TEMP_ROOT, exist_ok=True)
+    if mount_fstype(TEMP_ROOT) != 'tmpfs':
+        raise ValueError(f"MUSIFYX_TMP ({TEMP_ROOT}) no está en un sistema de archivos tmpfs")
+    stats = os.statvfs(TEMP_ROOT)
+    if stats.f_blocks * stats.f_frsize < TEMP_ROOT_MIN_BYTES:
+        raise ValueError(f"MUSIFYX_TMP ({TEMP_ROOT}) es menor que {TEMP_ROOT_MIN_BYTES} bytes")
+
+# Caché en disco de los ZIP de álbumes y playlists, indexada por (id, calidad).
+# Por defecto en el directorio temporal del sistema, que el proceso siempre puede
+# escribir; en producción conviene un ZIP_CACHE_DIR persistente
+CACHE_DIR = os.getenv('ZIP_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'musifyx-cache'))
+ZIP_CACHE_TTL = int(os.getenv('ZIP_CACHE_TTL', 7 * 24 * 3600))  # segundos
+ZIP_CACHE_SWEEP_INTERVAL = 3600  # segundos entre limpiezas de la caché
+ZIP_CLIENT_MAX_AGE = 86400  # segundos que el cliente puede reutilizar un ZIP sin revalidar
+os.makedirs(CACHE_DIR, exist_ok=True)
+
+# Si se define (p. ej. /internal/zips/), los ZIP de la caché se entregan con
+# X-Accel-Redirect y nginx los envía con sendfile(2) sin ocupar un worker.
+# Requiere en nginx una location interna con alias a ZIP_CACHE_DIR
+X_ACCEL_PREFIX = os.getenv('MUSIFYX_X_ACCEL_PREFIX')
+
+# Trabajos de descarga en segundo plano. El número de workers limita cuántas
+# descargas de álbumes/playlists se hacen a la vez contra Deezer con el ARL.
+# El estado de cada trabajo se guarda en CACHE_DIR (job_<id>.json) para que
+# cualquier worker de gunicorn pueda consultarlo, no solo el que lo creó
+JOB_WORKERS = int(os.getenv('MUSIFYX_JOB_WORKERS', 4))
+job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='musifyx-job')
+JOB_ID_RE = re.compile(r'[0-9a-f]{32}')
+
+# Máximo de trabajos pendientes (en cola o en curso) por worker; por encima se
+# responde 503 en lugar de acumular descargas en la cola de job_executor
+JOB_QUEUE_MAX = int(os.getenv('MUSIFYX_JOB_QUEUE_MAX', 32))
+job_slots = threading.BoundedSemaphore(JOB_QUEUE_MAX)
+
+# Cada worker vuelve a publicar sus contadores cada METRICS_HEARTBEAT_INTERVAL
+# segundos; /metrics descarta los que no se actualizaron en METRICS_STALE_AFTER,
+# que son de workers que ya no existen (en esta máquina o en otra)
+METRICS_HEARTBEAT_INTERVAL = 15  # segundos
+METRICS_STALE_AFTER = 3 * METRICS_HEARTBEAT_INTERVAL
+
+def worker_id():
+    """
+    Identificador de este worker en CACHE_DIR. Incluye el host porque la caché
+    puede compartirse entre máquinas y un PID solo no distingue sus workers
+    """
+    return f"{socket.gethostname()}_{os.getpid()}"
+
+def publish_download_stats():
+    """
+    Guarda los contadores de descargas de este proceso en CACHE_DIR
+    (metrics_<host>_<pid>.json), para que /metrics sume los de todos los workers.
+    Debe llamarse con download_stats_lock tomado.
+    """
+    try:
+        fd, part_path = tempfile.mkstemp(dir=CACHE_DIR, suffix='.part')
+        with os.fdopen(fd, 'w') as stats_file:
+            json.dump(download_stats, stats_file)
+        os.replace(part_path, os.path.join(CACHE_DIR, f"metrics_{worker_id()}.json"))
+    except OSError as e:
+        # Las métricas nunca deben hacer fallar una descarga
+        logger.warning(f"No se pudieron guardar las métricas de descargas: {e}")
+
+def schedule_metrics_heartbeat():
+    """Publica los contadores de descargas y programa la siguiente publicación"""
+    # Los procesos de descarga heredan este temporizador al hacer fork, pero no
+    # son workers: no deben aparecer en /metrics
+    if multiprocessing.parent_process() is not None:
+        return
+    with download_stats_lock:
+        publish_download_stats()
+    timer = threading.Timer(METRICS_HEARTBEAT_INTERVAL, schedule_metrics_heartbeat)
+    timer.daemon = True
+    timer.start()
+
+# Publicar al arrancar los contadores a cero: reemplaza el archivo que hubiera
+# dejado un proceso anterior con el mismo host y PID (p. ej. tras reiniciar)
+schedule_metrics_heartbeat()
+
+# Hilos compartidos para leer por adelantado los archivos que se agregan a los ZIP.
+# Son hilos reales del sistema: con monkey.patch_all() un ThreadPoolExecutor
+# normal corre en greenlets del mismo hilo y sus lecturas bloquearían el hub
+io_executor = NativeThreadPoolExecutor(max_workers=4)
 
 def sanitize_filename(filename):
     """Sanitiza el nombre de archivo para evitar caracteres problemáticos"""
-    filename = re.sub(r'[<>:"/\\|?*]', '_', filename)
+    filename = FILENAME_SANITIZE_RE.sub('_', filename)
     return filename
 
-@app.route('/download/song/<string:id>', methods=['GET'])
-def download_song(id):
+def audio_extension(quality):
+    """Extensión de los archivos de audio que genera deezspot para una calidad"""
+    return '.flac' if quality == 'FLAC' else '.mp3'
+
+def collect_audio_files(result, temp_dir, quality):
     """
-    Descarga una canción individual de Deezer
-    Parámetros:
-    - id: ID de la canción en Deezer
-    - quality: Calidad del audio ('MP3_128', 'MP3_320', 'FLAC') - opcional
+    Obtiene las rutas de los archivos de audio a partir del resultado de deezspot
+    (un Track, o un Album/Playlist con su lista de tracks), sin recorrer el disco.
+    Si el resultado no tiene la forma esperada se recorre temp_dir como alternativa.
     """
+    tracks = getattr(result, 'tracks', None)
+    if tracks is None:
+        tracks = [result]
     try:
-        quality = request.args.get('quality', 'MP3_320')  # Valor por defecto
-        allowed_qualities = ['MP3_128', 'MP3_320', 'FLAC']
-        
-        if quality not in allowed_qualities:
-            return jsonify({'error': f'Calidad no válida. Opciones permitidas: {allowed_qualities}'}), 400
-        
-        # Validar que el ID sea numérico
-        if not id.isdigit():
-            return jsonify({'error': 'ID de canción inválido'}), 400
-        
-        # Crear directorio temporal para la descarga
-        temp_dir = tempfile.mkdtemp()
-        song_url = f"https://www.deezer.com/track/{id}"
-        
-        logger.info(f"Iniciando descarga de canción: {song_url}, calidad: {quality}")
-        
-        # Descargar la canción
-        result = deezer.download_trackdee(
-            link_track=song_url,
-            output_dir=temp_dir,
-            quality_download=quality,
-            recursive_quality=False,
-            recursive_download=False
+        return [track.song_path for track in tracks if track.success and track.song_path]
+    except (AttributeError, TypeError):
+        logger.warning("Resultado de deezspot inesperado, buscando archivos en el directorio temporal")
+    
+    extension = audio_extension(quality)
+    audio_files = []
+    for root, dirs, files in os.walk(temp_dir):
+        for file in files:
+            if file.endswith(extension):
+                audio_files.append(os.path.join(root, file))
+    return audio_files
+
+# ffmpeg (opcional) para recodificar a MP3 de 128 kbps cuando Deezer entrega
+# una calidad superior a la pedida
+FFMPEG_PATH = shutil.which('ffmpeg')
+
+def transcode_to_mp3_128(audio_file):
+    """
+    Recodifica un archivo de audio que no es MP3 (p. ej. FLAC) a MP3 de 128 kbps
+    con ffmpeg/LAME y devuelve la ruta del nuevo archivo.
+    Si ffmpeg no está disponible devuelve el original.
+    """
+    if not FFMPEG_PATH:
+        return audio_file
+    
+    output_file = f"{os.path.splitext(audio_file)[0]}.mp3"
+    subprocess.run(
+        [FFMPEG_PATH, '-v', 'error', '-y', '-i', audio_file,
+         '-map', '0:a', '-map_metadata', '0',
+         '-c:a', 'libmp3lame', '-b:a', '128k', output_file],
+        check=True
+    )
+    os.remove(audio_file)
+    return output_file
+
+# Tamaño de bloque al leer los archivos de audio que se agregan al ZIP
+ZIP_CHUNK_SIZE = 64 * 1024
+
+# Bytes del ZIP que se acumulan antes de enviarlos al cliente y a la caché,
+# para escribir en bloques grandes en vez de muchas escrituras pequeñas
+ZIP_OUTPUT_BUFFER_SIZE = 1 << 20
+
+# Número de archivos que se leen por adelantado mientras se envía el actual
+ZIP_PREFETCH_DEPTH = 2
+
+# Fecha y permisos fijos de los miembros del ZIP: con los del archivo descargado
+# cada regeneración produciría bytes distintos con el mismo ETag (zip_etag)
+ZIP_MEMBER_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+ZIP_MEMBER_ATTR = 0o100644 << 16
+
+def prefetch_file(file_path, stop):
+    """
+    Lee un archivo completo y descarta los datos, para que esté en la caché de
+    páginas del sistema cuando el ZIP llegue a él. Se interrumpe si se activa
+    stop (el ZIP terminó o el cliente cortó la conexión).
+    """
+    try:
+        with open(file_path, 'rb') as source:
+            while not stop.is_set() and source.read(ZIP_CHUNK_SIZE):
+                pass
+    except OSError:
+        # El directorio temporal pudo eliminarse mientras tanto
+        pass
+
+class ZipStreamBuffer:
+    """
+    Buffer de escritura no posicionable para zipfile.
+    zipfile escribe aquí los bytes del ZIP y el generador los vacía por bloques,
+    de modo que el archivo nunca se guarda completo ni en disco ni en memoria.
+    """
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+        self._pending = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        self._pending += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def pending(self):
+        return self._pending
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        self._pending = 0
+        return data
+
+def stream_zip(audio_files, temp_dir):
+    """
+    Genera un ZIP con los archivos de audio por bloques, listo para enviarse
+    en una respuesta HTTP. No elimina temp_dir: de eso se encarga quien lo creó.
+    """
+    buffer = ZipStreamBuffer()
+    stop_prefetch = threading.Event()
+    next_prefetch = 1
+    try:
+        # MP3 y FLAC ya están comprimidos: DEFLATE apenas reduce el tamaño y
+        # consume mucha CPU, así que los archivos se guardan sin compresión
+        with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as zipf:
+            for index, file_path in enumerate(audio_files):
+                # Leer por adelantado los siguientes archivos mientras se envía este
+                while next_prefetch < min(len(audio_files), index + 1 + ZIP_PREFETCH_DEPTH):
+                    io_executor.submit(prefetch_file, audio_files[next_prefetch], stop_prefetch)
+                    next_prefetch += 1
+                
+                # Agregar archivo al ZIP manteniendo la estructura de carpetas relativas
+                arcname = os.path.relpath(file_path, temp_dir)
+                zinfo = zipfile.ZipInfo.from_file(file_path, arcname)
+                zinfo.date_time = ZIP_MEMBER_DATE_TIME
+                zinfo.external_attr = ZIP_MEMBER_ATTR
+                with open(file_path, 'rb') as source, zipf.open(zinfo, 'w') as dest:
+                    while True:
+                        chunk = source.read(ZIP_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        dest.write(chunk)
+                        if buffer.pending() >= ZIP_OUTPUT_BUFFER_SIZE:
+                            yield buffer.drain()
+        # Directorio central del ZIP
+        data = buffer.drain()
+        if data:
+            yield data
+    finally:
+        stop_prefetch.set()
+
+def zip_cache_path(kind, id, quality):
+    """Ruta del ZIP en caché para un álbum o playlist en una calidad dada"""
+    return os.path.join(CACHE_DIR, f"{kind}_{id}_{quality}.zip")
+
+def is_cache_fresh(cache_path):
+    """Indica si el ZIP existe en caché y no ha superado el TTL"""
+    try:
+        return time.time() - os.path.getmtime(cache_path) < ZIP_CACHE_TTL
+    except OSError:
+        return False
+
+def zip_etag(kind, id, quality, audio_files, temp_dir):
+    """
+    ETag determinista de un ZIP: depende del recurso, la calidad y la lista de
+    pistas (nombre y tamaño), no del momento en que se generó. stream_zip fija
+    la fecha y los permisos de cada miembro para que estos datos determinen los
+    bytes del ZIP, ya que Range e If-Range se resuelven con este ETag.
+    """
+    digest = hashlib.sha1(f"{kind}:{id}:{quality}".encode())
+    for file_path in audio_files:
+        digest.update(f"\n{os.path.relpath(file_path, temp_dir)}:{os.path.getsize(file_path)}".encode())
+    return digest.hexdigest()
+
+def send_cached_zip(cache_path, download_name):
+    """Envía un ZIP de la caché como archivo estático, con ETag para revalidar"""
+    if X_ACCEL_PREFIX:
+        # nginx sirve el archivo y resuelve él mismo Range y peticiones condicionales
+        return Response(
+            mimetype='application/zip',
+            headers={
+                'X-Accel-Redirect': f"{X_ACCEL_PREFIX.rstrip('/')}/{os.path.basename(cache_path)}",
+                'Content-Disposition': f'attachment; filename={download_name}'
+            }
         )
+    
+    mtime = os.path.getmtime(cache_path)
+    # Usar el mismo ETag que se envió al generar el ZIP, si se guardó
+    try:
+        with open(f"{cache_path}.etag") as etag_file:
+            etag = etag_file.read().strip()
+    except OSError:
+        etag = hashlib.sha1(f"{os.path.basename(cache_path)}:{mtime}".encode()).hexdigest()
+    
+    return send_file(
+        cache_path,
+        as_attachment=True,
+        download_name=download_name,
+        mimetype='application/zip',
+        conditional=True,
+        etag=etag,
+        last_modified=mtime,
+        max_age=ZIP_CLIENT_MAX_AGE
+    )
+
+def cache_zip_stream(chunks, cache_path, etag):
+    """
+    Reenvía los bloques del ZIP mientras los guarda en la caché junto a su ETag.
+    El archivo solo se publica en cache_path si el ZIP se generó completo.
+    """
+    fd, part_path = tempfile.mkstemp(dir=CACHE_DIR, suffix='.part')
+    completed = False
+    try:
+        with os.fdopen(fd, 'wb', buffering=ZIP_OUTPUT_BUFFER_SIZE) as cache_file:
+            for chunk in chunks:
+                cache_file.write(chunk)
+                yield chunk
+        with open(f"{cache_path}.etag", 'w') as etag_file:
+            etag_file.write(etag)
+        os.replace(part_path, cache_path)
+        completed = True
+    finally:
+        # Cerrar el generador interno aunque el cliente haya cortado la conexión
+        chunks.close()
+        if not completed:
+            try:
+                os.remove(part_path)
+            except OSError:
+                pass
+
+def evict_zip_cache():
+    """
+    Elimina de la caché los ZIP (con sus ETag, trabajos y restos parciales) que
+    superaron el TTL, y las métricas de los workers que dejaron de publicarlas
+    """
+    now = time.time()
+    try:
+        with os.scandir(CACHE_DIR) as entries:
+            for entry in entries:
+                if not entry.name.endswith(('.zip', '.etag', '.json', '.part')):
+                    continue
+                # Un worker activo sin descargas no reescribe sus métricas más que
+                # con el heartbeat, así que no se les aplica el TTL de los ZIP
+                max_age = METRICS_STALE_AFTER if entry.name.startswith('metrics_') else ZIP_CACHE_TTL
+                try:
+                    if now - entry.stat().st_mtime >= max_age:
+                        os.remove(entry.path)
+                except OSError as e:
+                    logger.error(f"No se pudo eliminar de la caché {entry.path}: {e}")
+    except OSError as e:
+        logger.error(f"No se pudo limpiar la caché de ZIP: {e}")
+
+def schedule_zip_cache_eviction():
+    """Limpia la caché y programa la siguiente limpieza en segundo plano"""
+    evict_zip_cache()
+    timer = threading.Timer(ZIP_CACHE_SWEEP_INTERVAL, schedule_zip_cache_eviction)
+    timer.daemon = True
+    timer.start()
+
+schedule_zip_cache_eviction()
+
+# Parámetros de cada tipo de descarga:
+# - method: método de DeeLogin que realiza la descarga
+# - link_arg: nombre del argumento con el enlace de Deezer
+# - url_path: segmento de la URL de Deezer
+# - bundle: si se entrega como ZIP (y se permite bajar de calidad si no está disponible)
+# - label: nombre del recurso en los mensajes, con su artículo
+DOWNLOAD_KINDS = {
+    'song': {
+        'method': 'download_trackdee',
+        'link_arg': 'link_track',
+        'url_path': 'track',
+        'bundle': False,
+        'label': ('la', 'canción')
+    },
+    'album': {
+        'method': 'download_albumdee',
+        'link_arg': 'link_album',
+        'url_path': 'album',
+        'bundle': True,
+        'label': ('el', 'álbum')
+    },
+    'playlist': {
+        'method': 'download_playlistdee',
+        'link_arg': 'link_playlist',
+        'url_path': 'playlist',
+        'bundle': True,
+        'label': ('la', 'playlist')
+    }
+}
+
+def validate_download_args(kind, id):
+    """
+    Valida la calidad y el ID de una petición de descarga.
+    Devuelve (quality, None) si son válidos o (None, respuesta de error).
+    """
+    quality = request.args.get('quality', 'MP3_320')  # Valor por defecto
+    
+    # Validar que el ID sea numérico
+    if not ID_RE.fullmatch(id):
+        return None, (jsonify({'error': f'ID de {DOWNLOAD_KINDS[kind]["label"][1]} inválido'}), 400)
+    
+    if quality not in ALLOWED_QUALITIES:
+        return None, (jsonify({'error': f'Calidad no válida. Opciones permitidas: {list(QUALITY_OPTIONS)}'}), 400)
+    
+    return quality, None
+
+def download_in_worker(kind, link, quality, temp_dir):
+    """
+    Realiza la descarga dentro de un proceso de download_pool y devuelve las
+    rutas de los archivos, que a diferencia del resultado de deezspot se pueden
+    enviar de vuelta al proceso principal.
+    """
+    spec = DOWNLOAD_KINDS[kind]
+    result = getattr(deezer, spec['method'])(
+        **{spec['link_arg']: link},
+        output_dir=temp_dir,
+        quality_download=quality,
+        recursive_quality=spec['bundle'],
+        recursive_download=False
+    )
+    return collect_audio_files(result, temp_dir, quality)
+
+def download_to(kind, id, quality, temp_dir):
+    """Descarga una canción, álbum o playlist en temp_dir y devuelve sus archivos de audio"""
+    spec = DOWNLOAD_KINDS[kind]
+    link = f"https://www.deezer.com/{spec['url_path']}/{id}"
+    
+    logger.info(f"Iniciando descarga de {spec['label'][1]}: {link}, calidad: {quality}")
+    
+    with download_stats_lock:
+        download_stats['waiting'] += 1
+        publish_download_stats()
+    with download_semaphore:
+        with download_stats_lock:
+            download_stats['waiting'] -= 1
+            download_stats['active'] += 1
+            publish_download_stats()
+        pool = get_download_pool()
+        try:
+            audio_files = pool.submit(download_in_worker, kind, link, quality, temp_dir).result()
+        except BrokenProcessPool:
+            # Un proceso murió (p. ej. por falta de memoria): esta descarga falla,
+            # pero las siguientes usan un pool nuevo
+            logger.error("Un proceso de descarga terminó de forma inesperada, se recrea el pool")
+            discard_download_pool(pool)
+            raise
+        finally:
+            with download_stats_lock:
+                download_stats['active'] -= 1
+                publish_download_stats()
+    
+    # Con recursive_quality deezspot puede entregar FLAC cuando se pidió MP3_128;
+    # recodificarlo evita enviar varias veces más bytes de los pedidos
+    if quality == 'MP3_128':
+        audio_files = [
+            file_path if file_path.endswith('.mp3') else transcode_to_mp3_128(file_path)
+            for file_path in audio_files
+        ]
+    
+    return audio_files
+
+def send_song(id, audio_file, temp_dir, quality):
+    """
+    Envía una canción descargada desde un archivo ya abierto, de modo que quien
+    la llama puede eliminar temp_dir en cuanto recibe la respuesta
+    """
+    # Extraer información del archivo para renombrarlo
+    original_filename = os.path.basename(audio_file)
+    
+    # Intentar extraer artista y título del nombre original si es posible
+    # El formato típico es "Artist - Title.ext" o similar
+    base_name = os.path.splitext(original_filename)[0]
+    
+    # Renombrar el archivo con el formato Artista - Título
+    # Este es un ejemplo de cómo podría formatearse - el cliente puede necesitar ajustar esto
+    # basándose en los metadatos reales disponibles
+    sanitized_name = sanitize_filename(base_name)
+    new_filename = f"{sanitized_name}{audio_extension(quality)}"
+    new_filepath = os.path.join(temp_dir, new_filename)
+    
+    # Si el nombre cambió, renombrar el archivo
+    if audio_file != new_filepath:
+        os.rename(audio_file, new_filepath)
+        audio_file = new_filepath
+    
+    logger.info(f"Canción descargada exitosamente: {new_filename}")
+    
+    # Abrir el archivo antes de que se borre el directorio temporal: en Linux
+    # los datos siguen accesibles por el descriptor abierto hasta cerrarlo
+    audio_handle = open(audio_file, 'rb')
+    file_size = os.fstat(audio_handle.fileno()).st_size
+    
+    # Enviar el archivo al cliente por bloques. Se pasa un archivo real para que
+    # el servidor pueda usar wsgi.file_wrapper (sendfile(2) en gunicorn). No se
+    # usa X-Accel-Redirect porque el archivo ya no existe en el disco.
+    # Cada petición vuelve a descargar la pista, así que el ETag se calcula a partir
+    # del ID, la calidad y el tamaño (no de la fecha del archivo) y no se envía
+    # Last-Modified, para que If-Range coincida al reanudar una descarga
+    response = send_file(
+        audio_handle,
+        as_attachment=True,
+        download_name=new_filename,
+        mimetype='audio/mpeg' if quality != 'FLAC' else 'audio/flac',
+        etag=hashlib.sha1(f"song:{id}:{quality}:{file_size}".encode()).hexdigest(),
+        conditional=False
+    )
+    
+    # Con un archivo abierto Werkzeug no conoce el tamaño, así que Range y las
+    # peticiones condicionales (para reanudar descargas) se resuelven aquí
+    response.content_length = file_size
+    try:
+        return response.make_conditional(request.environ, accept_ranges=True, complete_length=file_size)
+    except RequestedRangeNotSatisfiable:
+        audio_handle.close()
+        raise
+
+def handle_download(kind, id):
+    """
+    Atiende una descarga de cualquier tipo: valida la petición, sirve el ZIP
+    desde la caché si existe, descarga desde Deezer y envía la canción o el ZIP.
+    """
+    spec = DOWNLOAD_KINDS[kind]
+    article, label = spec['label']
+    temp_dir = None
+    try:
+        quality, error = validate_download_args(kind, id)
+        if error:
+            return error
         
-        # Buscar el archivo descargado
-        downloaded_files = []
-        for root, dirs, files in os.walk(temp_dir):
-            for file in files:
-                if file.endswith(('.mp3', '.flac')):
-                    downloaded_files.append(os.path.join(root, file))
-        
-        if not downloaded_files:
-            return jsonify({'error': 'No se encontró el archivo descargado'}), 500
-        
-        # Encontrar el archivo de audio correcto
-        audio_file = downloaded_files[0]
-        
-        # Extraer información del archivo para renombrarlo
-        original_filename = os.path.basename(audio_file)
+        # Servir desde la caché si el ZIP ya se generó recientemente
+        if spec['bundle']:
+            cache_path = zip_cache_path(kind, id, quality)
+            if is_cache_fresh(cache_path):
+                logger.info(f"Sirviendo ZIP desde la caché: {cache_path}")
+                return send_cached_zip(cache_path, f"{kind}_{id}.zip")
         
-        # Intentar extraer artista y título del nombre original si es posible
-        # El formato típico es "Artist - Title.ext" o similar
-        base_name = os.path.splitext(original_filename)[0]
+        # Crear directorio temporal para la descarga
+        temp_dir = tempfile.mkdtemp(prefix='musifyx_', dir=TEMP_ROOT)
+        audio_files = download_to(kind, id, quality, temp_dir)
         
-        # Renombrar el archivo con el formato Artista - Título
-        # Este es un ejemplo de cómo podría formatearse - el cliente puede necesitar ajustar esto
-        # basándose en los metadatos reales disponibles
-        sanitized_name = sanitize_filename(base_name)
-        new_filename = f"{sanitized_name}.{'flac' if quality == 'FLAC' else 'mp3'}"
-        new_filepath = os.path.join(temp_dir, new_filename)
+        if not audio_files:
+            if not spec['bundle']:
+                return jsonify({'error': 'No se encontró el archivo descargado'}), 500
+            return jsonify({'error': 'No se encontraron archivos descargados'}), 500
         
-        # Si el nombre cambió, renombrar el archivo
-        if audio_file != new_filepath:
-            os.rename(audio_file, new_filepath)
-            audio_file = new_filepath
+        if not spec['bundle']:
+            return send_song(id, audio_files[0], temp_dir, quality)
         
-        logger.info(f"Canción descargada exitosamente: {new_filename}")
+        logger.info(f"Descarga de {label} completada, enviando ZIP: {len(audio_files)} archivos")
         
-        # Enviar el archivo al cliente
-        response = send_file(
-            audio_file,
-            as_attachment=True,
-            download_name=new_filename,
-            mimetype='audio/mpeg' if quality != 'FLAC' else 'audio/flac'
+        # Enviar el ZIP al cliente a medida que se construye y guardarlo en caché.
+        # El ETag se conoce antes de generar el ZIP, así que se envía desde el inicio
+        etag = zip_etag(kind, id, quality, audio_files, temp_dir)
+        response = Response(
+            stream_with_context(cache_zip_stream(stream_zip(audio_files, temp_dir), cache_path, etag)),
+            mimetype='application/zip',
+            headers={'Content-Disposition': f'attachment; filename={kind}_{id}.zip'}
         )
-        
-        # Eliminar el archivo temporal después de enviarlo
-        @response.call_after_request
-        def remove_file(response):
-            try:
-                os.remove(audio_file)
-                os.rmdir(temp_dir)  # Intentar eliminar directorio si está vacío
-            except Exception as e:
-                logger.error(f"No se pudo eliminar archivos temporales: {e}")
-            
-            return response
-        
+        response.set_etag(etag)
+        # Los archivos se leen mientras se envía el ZIP, así que la respuesta pasa
+        # a ser dueña de temp_dir. call_on_close se ejecuta se envíe o no el
+        # cuerpo (p. ej. en HEAD el generador nunca llega a ejecutarse)
+        zip_dir, temp_dir = temp_dir, None
+        response.call_on_close(lambda: shutil.rmtree(zip_dir, ignore_errors=True))
         return response
         
     except Exception as e:
-        logger.error(f"Error al descargar canción: {str(e)}")
-        return jsonify({'error': f'Error al descargar la canción: {str(e)}'}), 500
+        # Errores HTTP como 416 (Range no válido) se devuelven tal cual
+        if isinstance(e, HTTPException):
+            raise
+        logger.error(f"Error al descargar {label}: {str(e)}")
+        return jsonify({'error': f'Error al descargar {article} {label}: {str(e)}'}), 500
+    
+    finally:
+        # Único punto de limpieza del directorio temporal, salvo que se haya
+        # entregado a una respuesta en streaming
+        if temp_dir:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+@app.route('/download/song/<string:id>', methods=['GET'])
+def download_song(id):
+    """
+    Descarga una canción individual de Deezer
+    Parámetros:
+    - id: ID de la canción en Deezer
+    - quality: Calidad del audio ('MP3_128', 'MP3_320', 'FLAC') - opcional
+    """
+    return handle_download('song', id)
 
 @app.route('/download/album/<string:id>', methods=['GET'])
 def download_album(id):
@@ -127,79 +781,7 @@ def download_album(id):
     - id: ID del álbum en Deezer
     - quality: Calidad del audio ('MP3_128', 'MP3_320', 'FLAC') - opcional
     """
-    try:
-        quality = request.args.get('quality', 'MP3_320')
-        allowed_qualities = ['MP3_128', 'MP3_320', 'FLAC']
-        
-        if quality not in allowed_qualities:
-            return jsonify({'error': f'Calidad no válida. Opciones permitidas: {allowed_qualities}'}), 400
-        
-        # Validar que el ID sea numérico
-        if not id.isdigit():
-            return jsonify({'error': 'ID de álbum inválido'}), 400
-        
-        # Crear directorio temporal para la descarga
-        temp_dir = tempfile.mkdtemp()
-        album_url = f"https://www.deezer.com/album/{id}"
-        
-        logger.info(f"Iniciando descarga de álbum: {album_url}, calidad: {quality}")
-        
-        # Descargar el álbum
-        result = deezer.download_albumdee(
-            link_album=album_url,
-            output_dir=temp_dir,
-            quality_download=quality,
-            recursive_quality=True,
-            recursive_download=False
-        )
-        
-        # Buscar todos los archivos de audio descargados
-        audio_files = []
-        for root, dirs, files in os.walk(temp_dir):
-            for file in files:
-                if file.endswith(('.mp3', '.flac')):
-                    audio_files.append(os.path.join(root, file))
-        
-        if not audio_files:
-            return jsonify({'error': 'No se encontraron archivos descargados'}), 500
-        
-        # Crear un archivo ZIP con todos los archivos
-        zip_path = os.path.join(temp_dir, f"album_{id}.zip")
-        import zipfile
-        
-        with zipfile.ZipFile(zip_path, 'w') as zipf:
-            for file_path in audio_files:
-                # Agregar archivo al ZIP manteniendo la estructura de carpetas relativas
-                arcname = os.path.relpath(file_path, temp_dir)
-                zipf.write(file_path, arcname)
-        
-        logger.info(f"Álbum descargado y empaquetado en ZIP: {len(audio_files)} archivos")
-        
-        # Enviar el archivo ZIP al cliente
-        response = send_file(
-            zip_path,
-            as_attachment=True,
-            download_name=f"album_{id}.zip",
-            mimetype='application/zip'
-        )
-        
-        # Eliminar archivos temporales después de enviar
-        @response.call_after_request
-        def remove_files(response):
-            try:
-                os.remove(zip_path)
-                # Eliminar directorio con todos sus contenidos
-                shutil.rmtree(temp_dir)
-            except Exception as e:
-                logger.error(f"No se pudieron eliminar archivos temporales: {e}")
-            
-            return response
-        
-        return response
-        
-    except Exception as e:
-        logger.error(f"Error al descargar álbum: {str(e)}")
-        return jsonify({'error': f'Error al descargar el álbum: {str(e)}'}), 500
+    return handle_download('album', id)
 
 @app.route('/download/playlist/<string:id>', methods=['GET'])
 def download_playlist(id):
@@ -209,79 +791,206 @@ def download_playlist(id):
     - id: ID de la playlist en Deezer
     - quality: Calidad del audio ('MP3_128', 'MP3_320', 'FLAC') - opcional
     """
+    return handle_download('playlist', id)
+
+def job_path(job_id):
+    """Ruta del archivo con el estado de un trabajo"""
+    return os.path.join(CACHE_DIR, f"job_{job_id}.json")
+
+def job_key_path(kind, id, quality):
+    """Ruta del archivo con el último trabajo creado para un álbum o playlist en una calidad"""
+    return os.path.join(CACHE_DIR, f"{kind}_{id}_{quality}.job.json")
+
+def is_worker_alive(worker):
+    """Indica si un worker (de esta u otra máquina) sigue publicando sus métricas"""
+    if worker == worker_id():
+        return True
     try:
-        quality = request.args.get('quality', 'MP3_320')
-        allowed_qualities = ['MP3_128', 'MP3_320', 'FLAC']
-        
-        if quality not in allowed_qualities:
-            return jsonify({'error': f'Calidad no válida. Opciones permitidas: {allowed_qualities}'}), 400
-        
-        # Validar que el ID sea numérico
-        if not id.isdigit():
-            return jsonify({'error': 'ID de playlist inválido'}), 400
-        
-        # Crear directorio temporal para la descarga
-        temp_dir = tempfile.mkdtemp()
-        playlist_url = f"https://www.deezer.com/playlist/{id}"
-        
-        logger.info(f"Iniciando descarga de playlist: {playlist_url}, calidad: {quality}")
-        
-        # Descargar la playlist
-        result = deezer.download_playlistdee(
-            link_playlist=playlist_url,
-            output_dir=temp_dir,
-            quality_download=quality,
-            recursive_quality=True,
-            recursive_download=False
-        )
-        
-        # Buscar todos los archivos de audio descargados
-        audio_files = []
-        for root, dirs, files in os.walk(temp_dir):
-            for file in files:
-                if file.endswith(('.mp3', '.flac')):
-                    audio_files.append(os.path.join(root, file))
-        
-        if not audio_files:
-            return jsonify({'error': 'No se encontraron archivos descargados'}), 500
-        
-        # Crear un archivo ZIP con todos los archivos
-        zip_path = os.path.join(temp_dir, f"playlist_{id}.zip")
-        import zipfile
-        
-        with zipfile.ZipFile(zip_path, 'w') as zipf:
-            for file_path in audio_files:
-                # Agregar archivo al ZIP manteniendo la estructura de carpetas relativas
-                arcname = os.path.relpath(file_path, temp_dir)
-                zipf.write(file_path, arcname)
-        
-        logger.info(f"Playlist descargada y empaquetada en ZIP: {len(audio_files)} archivos")
-        
-        # Enviar el archivo ZIP al cliente
-        response = send_file(
-            zip_path,
-            as_attachment=True,
-            download_name=f"playlist_{id}.zip",
-            mimetype='application/zip'
-        )
-        
-        # Eliminar archivos temporales después de enviar
-        @response.call_after_request
-        def remove_files(response):
-            try:
-                os.remove(zip_path)
-                # Eliminar directorio con todos sus contenidos
-                shutil.rmtree(temp_dir)
-            except Exception as e:
-                logger.error(f"No se pudieron eliminar archivos temporales: {e}")
+        return time.time() - os.path.getmtime(os.path.join(CACHE_DIR, f"metrics_{worker}.json")) < METRICS_STALE_AFTER
+    except OSError:
+        return False
+
+def read_job(job_id):
+    """
+    Lee el estado de un trabajo, o None si no existe. Un trabajo pendiente cuyo
+    worker ya no existe (reiniciado o terminado) nunca avanzará, así que se
+    marca como error para que los clientes dejen de consultarlo
+    """
+    if not JOB_ID_RE.fullmatch(job_id):
+        return None
+    try:
+        with open(job_path(job_id)) as job_file:
+            job = json.load(job_file)
+    except (OSError, ValueError):
+        return None
+    
+    if job['status'] in ('queued', 'running') and not is_worker_alive(job.get('worker')):
+        job.update(status='error', error='El worker que ejecutaba el trabajo terminó antes de completarlo')
+        write_job(job_id, job)
+    return job
+
+def write_cache_json(path, data):
+    """Guarda un archivo JSON en CACHE_DIR de forma atómica"""
+    fd, part_path = tempfile.mkstemp(dir=CACHE_DIR, suffix='.part')
+    with os.fdopen(fd, 'w') as json_file:
+        json.dump(data, json_file)
+    os.replace(part_path, path)
+
+def write_job(job_id, job):
+    """Guarda el estado de un trabajo de forma atómica"""
+    write_cache_json(job_path(job_id), job)
+
+def update_job(job_id, **fields):
+    """Actualiza el estado de un trabajo; solo lo modifica el worker que lo ejecuta (o read_job si ese worker ya no existe)"""
+    job = read_job(job_id)
+    job.update(fields)
+    write_job(job_id, job)
+
+def run_zip_job(job_id):
+    """
+    Descarga un álbum o playlist y deja su ZIP en la caché.
+    Se ejecuta en job_executor, fuera de los workers que atienden peticiones.
+    """
+    job = read_job(job_id)
+    kind, id, quality = job['kind'], job['id'], job['quality']
+    cache_path = zip_cache_path(kind, id, quality)
+    
+    if is_cache_fresh(cache_path):
+        update_job(job_id, status='done')
+        return
+    
+    update_job(job_id, status='running')
+    try:
+        # El directorio temporal se elimina al salir del bloque, incluso si la descarga falla
+        with tempfile.TemporaryDirectory(prefix='musifyx_', dir=TEMP_ROOT) as temp_dir:
+            audio_files = download_to(kind, id, quality, temp_dir)
+            if not audio_files:
+                raise RuntimeError('No se encontraron archivos descargados')
             
-            return response
-        
-        return response
-        
+            # Generar el ZIP directamente en la caché
+            etag = zip_etag(kind, id, quality, audio_files, temp_dir)
+            for _ in cache_zip_stream(stream_zip(audio_files, temp_dir), cache_path, etag):
+                pass
+            
+            logger.info(f"Trabajo {job_id}: ZIP generado con {len(audio_files)} archivos")
+            update_job(job_id, status='done')
     except Exception as e:
-        logger.error(f"Error al descargar playlist: {str(e)}")
-        return jsonify({'error': f'Error al descargar la playlist: {str(e)}'}), 500
+        logger.error(f"Trabajo {job_id}: error al descargar: {str(e)}")
+        update_job(job_id, status='error', error=str(e))
+
+def submit_zip_job(kind, id):
+    """
+    Valida la petición y encola la generación del ZIP de un álbum o playlist.
+    Si ya hay un trabajo pendiente para el mismo recurso y calidad, se devuelve
+    ese en lugar de descargarlo otra vez
+    """
+    quality, error = validate_download_args(kind, id)
+    if error:
+        return error
+    
+    key_path = job_key_path(kind, id, quality)
+    try:
+        with open(key_path) as key_file:
+            job_id = json.load(key_file)['job_id']
+    except (OSError, ValueError, KeyError):
+        job_id = None
+    job = read_job(job_id) if job_id else None
+    if job and job['status'] in ('queued', 'running'):
+        return jsonify({'job_id': job_id, 'status_url': f'/jobs/{job_id}'}), 202
+    
+    if not job_slots.acquire(blocking=False):
+        return jsonify({'error': 'Demasiados trabajos pendientes, inténtalo más tarde'}), 503
+    
+    job_id = uuid.uuid4().hex
+    write_job(job_id, {
+        'status': 'queued',
+        'kind': kind,
+        'id': id,
+        'quality': quality,
+        'worker': worker_id(),
+        'created': time.time()
+    })
+    write_cache_json(key_path, {'job_id': job_id})
+    job_executor.submit(run_zip_job, job_id).add_done_callback(lambda _: job_slots.release())
+    
+    return jsonify({'job_id': job_id, 'status_url': f'/jobs/{job_id}'}), 202
+
+@app.route('/download/album/<string:id>', methods=['POST'])
+def create_album_job(id):
+    """Crea un trabajo en segundo plano que genera el ZIP de un álbum"""
+    return submit_zip_job('album', id)
+
+@app.route('/download/playlist/<string:id>', methods=['POST'])
+def create_playlist_job(id):
+    """Crea un trabajo en segundo plano que genera el ZIP de una playlist"""
+    return submit_zip_job('playlist', id)
+
+@app.route('/jobs/<string:job_id>', methods=['GET'])
+def get_job(job_id):
+    """Consulta el estado de un trabajo: queued, running, done o error"""
+    job = read_job(job_id)
+    
+    if job is None:
+        return jsonify({'error': 'Trabajo no encontrado'}), 404
+    
+    job['job_id'] = job_id
+    if job['status'] == 'done':
+        job['file_url'] = f'/jobs/{job_id}/file'
+    return jsonify(job)
+
+@app.route('/jobs/<string:job_id>/file', methods=['GET'])
+def get_job_file(job_id):
+    """Descarga el ZIP generado por un trabajo terminado"""
+    job = read_job(job_id)
+    
+    if job is None:
+        return jsonify({'error': 'Trabajo no encontrado'}), 404
+    
+    if job['status'] != 'done':
+        return jsonify({'error': 'El trabajo aún no ha terminado', 'status': job['status']}), 409
+    
+    cache_path = zip_cache_path(job['kind'], job['id'], job['quality'])
+    if not is_cache_fresh(cache_path):
+        return jsonify({'error': 'El archivo del trabajo ha expirado'}), 410
+    
+    return send_cached_zip(cache_path, f"{job['kind']}_{job['id']}.zip")
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Estado de la cola de descargas de todos los workers, para ajustar
+    MUSIFYX_MAX_PARALLEL (el límite se aplica en cada worker)
+    """
+    stats = {'active': 0, 'waiting': 0}
+    workers_reporting = 0
+    job_counts = {}
+    now = time.time()
+    with os.scandir(CACHE_DIR) as entries:
+        for entry in entries:
+            if entry.name.startswith('job_') and entry.name.endswith('.json'):
+                job = read_job(entry.name[len('job_'):-len('.json')])
+                if job:
+                    job_counts[job['status']] = job_counts.get(job['status'], 0) + 1
+            elif entry.name.startswith('metrics_') and entry.name.endswith('.json'):
+                try:
+                    # Worker que dejó de publicar (ya no existe): sus contadores no cuentan
+                    if now - entry.stat().st_mtime >= METRICS_STALE_AFTER:
+                        continue
+                    with open(entry.path) as stats_file:
+                        worker_stats = json.load(stats_file)
+                except (OSError, ValueError):
+                    continue
+                workers_reporting += 1
+                stats['active'] += worker_stats.get('active', 0)
+                stats['waiting'] += worker_stats.get('waiting', 0)
+    
+    return jsonify({
+        'downloads_active': stats['active'],
+        'downloads_waiting': stats['waiting'],
+        'max_parallel_downloads': MAX_PARALLEL_DOWNLOADS,
+        'workers_reporting': workers_reporting,
+        'jobs': job_counts
+    })
 
 @app.route('/', methods=['GET'])
 def index():
@@ -291,7 +1000,12 @@ def index():
         'endpoints': {
             '/download/song/<id>': 'Descargar canción individual',
             '/download/album/<id>': 'Descargar álbum completo',
-            '/download/playlist/<id>': 'Descargar playlist completa'
+            '/download/playlist/<id>': 'Descargar playlist completa',
+            'POST /download/album/<id>': 'Generar el ZIP de un álbum en segundo plano',
+            'POST /download/playlist/<id>': 'Generar el ZIP de una playlist en segundo plano',
+            '/jobs/<job_id>': 'Estado de un trabajo en segundo plano',
+            '/jobs/<job_id>/file': 'Descargar el ZIP de un trabajo terminado',
+            '/metrics': 'Descargas en curso y en espera'
         },
         'parameters': {
             'quality': 'MP3_128, MP3_320, FLAC (solo para Deezer Premium)'
@@ -306,8 +1020,18 @@ def not_found(error):
 def internal_error(error):
     return jsonify({'error': 'Error interno del servidor'}), 500
 
+# Crear el pool al arrancar el worker, antes de aceptar conexiones, y al final del
+# módulo para que los procesos hereden todas sus funciones. Si se rompe, el nuevo
+# se crea durante una petición e init_download_worker suelta los sockets heredados
+get_download_pool()
+
 if __name__ == '__main__':
-    # Ejecutar la aplicación
+    # Ejecutar la aplicación con el servidor WSGI de gevent: un solo proceso
+    # atiende muchas descargas simultáneas sin bloquear un hilo por cliente.
+    # En producción: WEB_CONCURRENCY=$NCPU gunicorn -k gevent --worker-connections 1000 app:app
+    # (WEB_CONCURRENCY fija los workers y reparte entre ellos los procesos de descarga)
+    # gunicorn expone wsgi.file_wrapper, así que las canciones se envían con
+    # sendfile(2); detrás de nginx definir MUSIFYX_X_ACCEL_PREFIX para los ZIP
     port = int(os.environ.get('PORT', 5000))
-    debug = os.environ.get('FLASK_DEBUG', 'False').lower() == 'true'
-    app.run(host='0.0.0.0', port=port, debug=debug)
\ No newline at end of file
+    app.debug = os.environ.get('FLASK_DEBUG', 'False').lower() == 'true'
+    WSGIServer(('0.0.0.0', port), app).serve_forever()